@@ -1,85 +1,318 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
 import os
+import re
+import shutil
 import sys
 import subprocess
+import traceback
 from parmed.amber import AmberParm
 
-def require_file(path):
-    if not os.path.isfile(path):
-        sys.stderr.write(f"ERROR: Required file not found: {path}\n")
+def require_files(paths):
+    # one scandir per parent directory instead of one stat per file
+    groups = collections.defaultdict(set)
+    for p in paths:
+        groups[os.path.dirname(p) or "."].add(os.path.basename(p))
+    missing = []
+    for d, names in groups.items():
+        try:
+            with os.scandir(d) as it:
+                have = {e.name for e in it if e.name in names and e.is_file()}
+        except OSError:
+            have = set()
+        # names not in the listing may still exist (case-insensitive or
+        # normalising filesystems, unlistable directories); stat those
+        missing.extend(path for path in (os.path.join(d, n) for n in sorted(names - have))
+                       if not os.path.isfile(path))
+    if missing:
+        for path in missing:
+            sys.stderr.write(f"ERROR: Required file not found: {path}\n")
         sys.exit(1)
 
+def find_program(name):
+    """Absolute path of an executable on PATH, or None."""
+    path = shutil.which(name)
+    return os.path.abspath(path) if path else None
+
+def write_file(path, text):
+    """Write text to path with a single encode and (normally) one write syscall."""
+    payload = memoryview(text.encode())
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while payload:
+            payload = payload[os.write(fd, payload):]
+    finally:
+        os.close(fd)
+
+def write_atomic(path, payload):
+    """Write bytes to path via a temp file + os.replace, so path is never torn."""
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb", buffering=1 << 20) as f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
 # ─── helper: detect metals in MOL2 (skip GAFF fallback if present) ─────────────
-def mol2_has_metal(mol2_path):
+_METALS = frozenset(b"Fe Cu Zn Mg Mn Co Ni Mo W V Ca K Na".split())
+# every upper/lower-case spelling of each symbol (FE, Fe, fE, fe, ...), so atom
+# tokens can be tested as-is without canonicalizing them first
+_METAL_TOKENS = frozenset(
+    bytes(chars)
+    for m in _METALS
+    for chars in itertools.product(*((c, c ^ 0x20) for c in m))
+)
+# cheap whole-file pre-filter: any metal symbol not embedded in a longer word
+_METAL_AC = re.compile(rb'(?<![A-Za-z])(?:' + b'|'.join(sorted(_METALS)) + rb')(?![A-Za-z])', re.I)
+_MOL2_ATOM_RE = re.compile(rb'@<TRIPOS>ATOM', re.I)
+_MOL2_BOND_RE = re.compile(rb'@<TRIPOS>BOND', re.I)
+# atom_id, atom_name, x, y, z, atom_type as whole tokens; name and type capture
+# their first run of letters ("1ZN" -> ZN, "'Fe'" -> Fe, "C1A" -> C)
+_ATOM_RE = re.compile(
+    rb'^[ \t]*\S+[ \t]+(?=\S)[^A-Za-z\s]*([A-Za-z]*)\S*'
+    rb'[ \t]+\S+[ \t]+\S+[ \t]+\S+[ \t]+(?=\S)[^A-Za-z\s]*([A-Za-z]*)', re.M)
+
+def _scan_mol2_metal(mol2_path):
+    """Scan the MOL2 ATOM block; raises OSError if the file cannot be read."""
+    with open(mol2_path, "rb", buffering=1 << 20) as f:
+        data = f.read()
+    if _METAL_AC.search(data) is None:
+        return False
+    start = _MOL2_ATOM_RE.search(data)
+    if start is None:
+        return False
+    end = _MOL2_BOND_RE.search(data, start.end())
+    block = data[start.end():end.start() if end else len(data)]
+    for m in _ATOM_RE.finditer(block):
+        if m.group(1) in _METAL_TOKENS or m.group(2) in _METAL_TOKENS:
+            return True
+    return False
+
+# bump whenever _scan_mol2_metal's verdict can change, so old sidecars are ignored
+_METALCACHE_VERSION = 1
+
+@functools.lru_cache(maxsize=128)
+def _mol2_has_metal_cached(abspath, mtime_ns, size):
+    # sidecar cache lets repeated runs over the same MOL2 skip the scan
+    sidecar = abspath + ".metalcache"
+    try:
+        with open(sidecar) as f:
+            cached = json.load(f)
+        if (cached["v"] == _METALCACHE_VERSION
+                and cached["size"] == size and cached["mtime_ns"] == mtime_ns):
+            return bool(cached["has_metal"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    # a read error propagates, so lru_cache does not remember it
+    found = _scan_mol2_metal(abspath)
+    try:
+        write_atomic(sidecar, json.dumps({"v": _METALCACHE_VERSION, "size": size,
+                                          "mtime_ns": mtime_ns, "has_metal": found}).encode())
+    except OSError:
+        pass
+    return found
+
+def mol2_has_metal(path):
     """Crude check for common metals in MOL2 atom name/type fields."""
-    metals = {"Fe","Cu","Zn","Mg","Mn","Co","Ni","Mo","W","V","Ca","K","Na"}
     try:
-        with open(mol2_path, "r") as f:
-            in_atom = False
-            for line in f:
-                ls = line.strip()
-                up = ls.upper()
-                if up.startswith("@<TRIPOS>ATOM"):
-                    in_atom = True
-                    continue
-                if up.startswith("@<TRIPOS>BOND"):
-                    break
-                if in_atom and ls:
-                    parts = ls.split()
-                    if len(parts) >= 6:
-                        name = ''.join(c for c in parts[1] if c.isalpha())
-                        atype = ''.join(c for c in parts[5] if c.isalpha())
-                        def canon(el):
-                            if not el: return el
-                            if len(el) == 1: return el.upper()
-                            return el[0].upper() + el[1:].lower()
-                        if canon(name) in metals or canon(atype) in metals:
-                            return True
-    except Exception:
-        # Be conservative on parse errors
+        st = os.stat(path)
+        return _mol2_has_metal_cached(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    except OSError:
+        # Be conservative on read errors
         return True
-    return False
+
+# ─── ITP sections: [ defaults ]/[ atomtypes ] go to the forcefield file ─────────
+_SECTION_RE = re.compile(rb'^\s*\[\s*(\w+)\s*\]')
+_FF_SECTIONS = frozenset({b"defaults", b"atomtypes"})
+_KEEP_SECTIONS = frozenset({
+    b"moleculetype",
+    b"atoms",
+    b"bonds",
+    b"pairs",
+    b"angles",
+    b"dihedrals",
+})
+
+def split_itp(raw):
+    """Split ParmEd .itp bytes into ([ defaults ]+[ atomtypes ], molecule sections)."""
+    ff_lines, keep_lines = [], []
+    in_ff_block, ff_done, in_keep_block = False, False, False
+    for line in raw.splitlines(keepends=True):
+        # memchr-speed guard so body lines never reach the regex
+        m = _SECTION_RE.match(line) if b"[" in line else None
+        if m:
+            name = m.group(1)
+            if name in _FF_SECTIONS:
+                # only the first contiguous defaults/atomtypes block
+                in_ff_block = not ff_done
+            elif in_ff_block:
+                in_ff_block, ff_done = False, True
+            in_keep_block = name in _KEEP_SECTIONS
+        if in_ff_block:
+            ff_lines.append(line)
+        if in_keep_block:
+            keep_lines.append(line)
+    return b"".join(ff_lines), b"".join(keep_lines)
 
 # ─── NEW helper to run tleap + check for empty prmtop ───────────────────────────
-def run_tleap(prefix, mol2_fn, frcmod_fn, sources):
+# tleap diagnostics that a GAFF (antechamber + parmchk2) rebuild can fix; kept
+# case-sensitive so the harmless "(UNKNOWN ATOM TYPE: FE)" frcmod note is ignored
+_TLEAP_MISS_RE = re.compile(
+    rb'Could not find .* parameter|does not have a type|Failed to generate parameters')
+
+def run_tleap(prefix, mol2_fn, frcmod_fn, sources, tleap="tleap"):
     # write leap.in from a list of source files
-    with open("leap.in", "w") as f:
-        for src in sources:
-            f.write(f"source {src}\n")
-        f.write(f"""
+    write_file("leap.in", "".join(f"source {src}\n" for src in sources) + f"""
 LIG = loadMol2 {mol2_fn}
 loadAmberParams {frcmod_fn}
 saveAmberParm LIG {prefix}.prmtop {prefix}.rst7
 quit
 """)
-    # run tleap and capture output
-    res = subprocess.run(["tleap", "-f", "leap.in"],
-                         capture_output=True, text=True)
-    print("=== tleap stdout ===\n", res.stdout, file=sys.stderr)
-    print("=== tleap stderr ===\n", res.stderr, file=sys.stderr)
-    if res.returncode:
-        return False
+    # run tleap, streaming its output to our stderr and noting as it goes
+    # whether it failed on something a GAFF rebuild could fix (tleap prints
+    # its diagnostics on stdout, so both streams are merged)
+    print("=== tleap ===", file=sys.stderr, flush=True)
+    needs_gaff = False
+    with subprocess.Popen([tleap, "-f", "leap.in"], stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as proc:
+        for line in proc.stdout:
+            sys.stderr.buffer.write(line)
+            sys.stderr.buffer.flush()
+            if not needs_gaff and _TLEAP_MISS_RE.search(line):
+                needs_gaff = True
+    if proc.returncode:
+        return False, needs_gaff
 
-    prmtop = f"{prefix}.prmtop"
-    if not os.path.isfile(prmtop) or os.path.getsize(prmtop) == 0:
-        return False
+    try:
+        return os.stat(f"{prefix}.prmtop").st_size > 0, needs_gaff
+    except FileNotFoundError:
+        return False, needs_gaff
+# ────────────────────────────────────────────────────────────────────────────────
+
+# ─── inputs: command-line flags / manifest columns, prompting for any missing ───
+# (key, prompt); each key is also a --flag (with "-") and a manifest CSV column
+FIELDS = [
+    ("mol2",       "Path to MOL2 file (e.g. lib/HEM/3ARC_HEM.mol2): "),
+    ("frcmod",     "Path to FRCMOD file (e.g. lib/HEM/3ARC_HEM.frcmod): "),
+    ("prefix",     "Output prefix (e.g. 3ARC_HEM): "),
+    ("leap_prot",  "Path to leaprc.protein.ff14SB (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.protein.ff14SB): "),
+    ("leap_lipid", "Path to leaprc.lipid21 (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.lipid21): "),
+    ("leap_gaff",  "Path to leaprc.gaff (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.gaff): "),
+]
+
+def _positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(
+        description="Build GROMACS .gro/.itp/topol.top for a ligand or cofactor "
+                    "from its AMBER MOL2 + FRCMOD.")
+    for key, prompt in FIELDS:
+        ap.add_argument("--" + key.replace("_", "-"), dest=key,
+                        help=prompt.split(" (e.g.")[0])
+    ap.add_argument("--manifest",
+                    help="CSV with one ligand per row (columns: "
+                         + ",".join(key for key, _ in FIELDS)
+                         + "); empty/missing columns fall back to the flags above. "
+                           "Each ligand's MOL2 must be in its own directory, since "
+                           "leap.in, topol.top and tleap's leap.log are written there.")
+    ap.add_argument("-j", "--jobs", type=_positive_int, default=os.cpu_count(),
+                    help="number of ligands from --manifest to build in parallel")
+    return ap.parse_args(argv)
+
+def fill_missing(params):
+    """Prompt for inputs not given on the command line (interactive runs only)."""
+    for key, prompt in FIELDS:
+        if not params.get(key):
+            if not sys.stdin.isatty():
+                sys.exit(f"ERROR: --{key.replace('_', '-')} is required when stdin is not a terminal")
+            params[key] = input(prompt).strip()
+    return params
+
+def _generate_one(params):
+    # pool worker: turn any failure into a logged non-zero code, so one bad
+    # ligand neither kills its worker nor aborts the rest of the batch
+    try:
+        generate(params)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        if e.code is not None:
+            sys.stderr.write(f"[{params['prefix']}] {e.code}\n")
+        return 1
+    except Exception:
+        sys.stderr.write(f"[{params['prefix']}] {traceback.format_exc()}")
+        return 1
+    return 0
+
+def main(argv=None):
+    args = parse_args(argv)
+    defaults = {key: getattr(args, key) for key, _ in FIELDS}
+    if not args.manifest:
+        generate(fill_missing(defaults))
+        return
+
+    with open(args.manifest, newline="") as f:
+        rows = []
+        for row in csv.DictReader(f):
+            cells = {k: (v or "").strip() for k, v in row.items() if k in defaults}
+            rows.append({**defaults, **{k: v for k, v in cells.items() if v}})
+    for i, row in enumerate(rows, 2):
+        missing = [key for key, _ in FIELDS if not row.get(key)]
+        if missing:
+            sys.exit(f"ERROR: {args.manifest} line {i}: no value for {', '.join(missing)}")
+        # generate() chdirs into each ligand's directory; pin paths to our cwd
+        for key, _ in FIELDS:
+            if key != "prefix":
+                row[key] = os.path.abspath(row[key])
 
-    return True
+    # rows building in the same directory would race on leap.in/topol.top/leap.log
+    by_dir = collections.defaultdict(list)
+    for i, row in enumerate(rows, 2):
+        by_dir[os.path.dirname(row["mol2"])].append(str(i))
+    shared = {d: lines for d, lines in by_dir.items() if len(lines) > 1}
+    if shared:
+        for d, lines in shared.items():
+            sys.stderr.write(f"ERROR: {args.manifest} lines {', '.join(lines)} all build in {d}\n")
+        sys.exit("ERROR: each manifest ligand needs its own directory")
+
+    # one fresh process per ligand, so each starts from a clean cwd
+    with multiprocessing.Pool(args.jobs, maxtasksperchild=1) as pool:
+        codes = pool.map(_generate_one, rows, chunksize=1)
+    failed = [row["prefix"] for row, code in zip(rows, codes) if code]
+    if failed:
+        sys.exit(f"ERROR: {len(failed)}/{len(rows)} ligands failed: {', '.join(failed)}")
 # ────────────────────────────────────────────────────────────────────────────────
 
-def main():
-    # Prompt user for all required paths
-    mol2       = input("Path to MOL2 file (e.g. lib/HEM/3ARC_HEM.mol2): ").strip()
-    frcmod     = input("Path to FRCMOD file (e.g. lib/HEM/3ARC_HEM.frcmod): ").strip()
-    prefix     = input("Output prefix (e.g. 3ARC_HEM): ").strip()
-    leap_prot  = input("Path to leaprc.protein.ff14SB (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.protein.ff14SB): ").strip()
-    leap_lipid = input("Path to leaprc.lipid21 (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.lipid21): ").strip()
-    leap_gaff  = input("Path to leaprc.gaff (e.g. /Users/sama578/opt/anaconda3/envs/py/dat/leap/cmd/leaprc.gaff): ").strip()
+def generate(params):
+    mol2       = params["mol2"]
+    frcmod     = params["frcmod"]
+    prefix     = params["prefix"]
+    leap_prot  = params["leap_prot"]
+    leap_lipid = params["leap_lipid"]
+    leap_gaff  = params["leap_gaff"]
 
-    # 1) Verify inputs
-    for p in (mol2, frcmod, leap_prot, leap_lipid, leap_gaff):
-        require_file(p)
+    # 1) Verify inputs and resolve AmberTools binaries once
+    require_files([mol2, frcmod, leap_prot, leap_lipid, leap_gaff])
+    tleap       = find_program("tleap") or sys.exit("ERROR: tleap not found on PATH")
+    antechamber = find_program("antechamber")
+    parmchk2    = find_program("parmchk2")
 
     # Change into directory of MOL2/FRCMOD so outputs go there
     workdir   = os.path.dirname(os.path.abspath(mol2)) or "."
@@ -89,32 +322,30 @@ def main():
 
     print(f"\nParameterizing {mol2_fn} + {frcmod_fn} → prefix '{prefix}' in {workdir}\n")
 
-    # 2) Write leap.in (initial version)
-    #    (this will be overwritten by run_tleap when invoked)
-    leap_in = f"""
-source {leap_prot}
-source {leap_lipid}
-source {leap_gaff}
-LIG = loadMol2 {mol2_fn}
-loadAmberParams {frcmod_fn}
-saveAmberParm LIG {prefix}.prmtop {prefix}.rst7
-quit
-"""
-    with open("leap.in","w") as f:
-        f.write(leap_in)
-
-    # ─── steps 3–4 with a two-attempt run_tleap + fallback ──────────────
+    # ─── steps 2–4 with a two-attempt run_tleap (writes leap.in) + fallback ──────────────
     # First attempt: protein + lipid21 + GAFF (using provided MOL2+FRCMOD)
     sources = [leap_prot, leap_lipid, leap_gaff]
-    if not run_tleap(prefix, mol2_fn, frcmod_fn, sources):
+    ok, needs_gaff = run_tleap(prefix, mol2_fn, frcmod_fn, sources, tleap)
+    if not ok:
         sys.stderr.write("First tleap build failed (protein+lipid21+gaff).\n")
 
+        # Only atom-typing/parameter failures can be fixed by GAFF; anything
+        # else would fail again after a (slow) antechamber AM1-BCC run
+        if not needs_gaff:
+            sys.stderr.write("tleap failure is not about missing atom types/parameters; "
+                             "skipping GAFF fallback.\n")
+            sys.exit(1)
+
         # Metal guard: do NOT use antechamber/GAFF for metal-containing ligands
         if mol2_has_metal(mol2_fn):
             sys.stderr.write("Detected metal center in MOL2; skipping GAFF fallback (antechamber).\n"
                              "Use curated FRCMOD/MCPB.py for metal complexes.\n")
             sys.exit(1)
 
+        if not (antechamber and parmchk2):
+            sys.stderr.write("antechamber/parmchk2 not found on PATH; cannot run GAFF fallback.\n")
+            sys.exit(1)
+
         # Fallback (organic ligands only): generate GAFF mol2/frcmod via antechamber+parmchk2
         gaff_mol2   = f"{prefix}_gaff.mol2"
         gaff_frcmod = f"{prefix}.frcmod"
@@ -122,25 +353,26 @@ quit
         try:
             # 1) antechamber --> GAFF atom types + AM1-BCC charges
             subprocess.run([
-                "antechamber",
+                antechamber,
                 "-i",  mol2_fn,   "-fi", "mol2",
                 "-o",  gaff_mol2, "-fo", "mol2",
                 "-c",  "bcc",     "-s",  "2",    "-at", "gaff"
-            ], check=True)
+            ], stdin=subprocess.DEVNULL, check=True)
 
             # 2) parmchk2 --> missing bond/angle/dihedral params
             subprocess.run([
-                "parmchk2",
+                parmchk2,
                 "-i", gaff_mol2, "-f", "mol2",
                 "-o", gaff_frcmod
-            ], check=True)
+            ], stdin=subprocess.DEVNULL, check=True)
         except subprocess.CalledProcessError as e:
             sys.stderr.write(f"GAFF fallback failed during antechamber/parmchk2: {e}\n")
             sys.exit(1)
 
         # Retry tleap with GAFF outputs
         sources = [leap_prot, leap_gaff]
-        if not run_tleap(prefix, gaff_mol2, gaff_frcmod, sources):
+        ok, _ = run_tleap(prefix, gaff_mol2, gaff_frcmod, sources, tleap)
+        if not ok:
             sys.stderr.write("ERROR: GAFF fallback tleap build also failed—no prmtop generated\n")
             sys.exit(1)
 
@@ -155,14 +387,13 @@ quit
         sys.exit(1)
     print(f"Loaded AmberParm: {len(parm.atoms)} atoms, {len(parm.bond_types)} bonds")
 
-    # 6) Write .gro and .itp
-    parm.save(f"{prefix}.gro", format="gro")
-    parm.save(f"{prefix}.itp", format="gromacs")
+    # 6) Write .gro and .itp (reruns regenerate them, like the prmtop and topol.top)
+    parm.save(f"{prefix}.gro", format="gro", overwrite=True)
+    parm.save(f"{prefix}.itp", format="gromacs", overwrite=True)
     print(f"--> Built {prefix}.gro & {prefix}.itp")
 
     # 7) Write master topol.top
-    with open("topol.top","w") as f:
-        f.write(f""";;
+    write_file("topol.top", f""";;
 ;; Generated by python script
 ;; Correspondance: sumansamantray06@gmail.com
 ;;
@@ -180,42 +411,15 @@ quit
 """)
     print("--> Generated topol.top file")
 
-    # 8) Extract [ defaults ] + [ atomtypes ] to sample_forcefield.itp
+    # 8) Extract [ defaults ] + [ atomtypes ] to sample_forcefield.itp and
+    # 9) strip them from the .itp in-place, in a single pass over the file
     srcfile = f"{prefix}.itp"
     dstfile = f"{prefix}_forcefield.itp"
-    with open(srcfile) as src, open(dstfile,"w") as dst:
-        in_block = False
-        for line in src:
-            stripped = line.strip()
-            if stripped.startswith("[ defaults ]") or stripped.startswith("[ atomtypes ]"):
-                in_block = True
-            elif in_block and stripped.startswith("[") and not stripped.startswith("[ atomtypes ]"):
-                break
-            if in_block:
-                dst.write(line)
+    with open(srcfile, "rb", buffering=1 << 20) as src:
+        ff_itp, kept_itp = split_itp(src.read())
+    write_atomic(dstfile, ff_itp)
+    write_atomic(srcfile, kept_itp)
     print(f"--> Generated {dstfile} file")
-
-    # 9) Strip [ defaults ] & [ atomtypes ] from the .itp in-place
-    keep = {
-        "[ moleculetype ]",
-        "[ atoms ]",
-        "[ bonds ]",
-        "[ pairs ]",
-        "[ angles ]",
-        "[ dihedrals ]",
-    }
-    lines, write = [], False
-    with open(srcfile) as src:
-        for line in src:
-            stripped = line.strip()
-            if any(stripped.startswith(h) for h in keep):
-                write = True
-            elif write and stripped.startswith("[") and stripped not in keep:
-                write = False
-            if write:
-                lines.append(line)
-    with open(srcfile,"w") as dst:
-        dst.writelines(lines)
     print(f"--> Generated {srcfile} file")
 
 if __name__=="__main__":
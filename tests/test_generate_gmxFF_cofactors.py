@@ -0,0 +1,286 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import generate_gmxFF_cofactors as gen
+
+HEM = os.path.join(ROOT, "examples", "lib", "HEM")
+
+
+def _mol2(tmp_path, atoms, header="@<TRIPOS>ATOM", extra="", name="lig.mol2"):
+    path = tmp_path / name
+    path.write_text("@<TRIPOS>MOLECULE\nLIG\n" + header + "\n" + "".join(
+        "%3d %-4s 0.0 0.0 0.0 %-4s 1 LIG 0.0\n" % (i, name, atype)
+        for i, (name, atype) in enumerate(atoms, 1)) + "@<TRIPOS>BOND\n" + extra)
+    return str(path)
+
+
+def test_mol2_has_metal_example_heme(tmp_path):
+    mol2 = tmp_path / "3ARC_HEM.mol2"
+    with open(os.path.join(HEM, "3ARC_HEM.mol2"), "rb") as f:
+        mol2.write_bytes(f.read())
+    assert gen.mol2_has_metal(str(mol2)) is True
+
+
+def test_mol2_has_metal_organic(tmp_path):
+    # C1A takes its leading letters only, so it is not read as calcium
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("C1A", "c3"), ("O1", "o")])) is False
+
+
+def test_mol2_has_metal_non_letter_names(tmp_path):
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("C1", "c3"), ("1ZN", "c3")], name="a.mol2")) is True
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("C1", "c3"), ("'ZN'", "c3")], name="b.mol2")) is True
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("C1", "c3"), ("2X", "Zn")], name="c.mol2")) is True
+
+
+def test_mol2_has_metal_lowercase_section_headers(tmp_path):
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("FE", "fe")], header="@<tripos>atom")) is True
+
+
+def test_mol2_has_metal_ignores_metals_outside_atom_block(tmp_path):
+    extra = "@<TRIPOS>SUBSTRUCTURE\n  1 ZN  1 RESIDUE\n"
+    assert gen.mol2_has_metal(_mol2(tmp_path, [("C1", "c3")], extra=extra)) is False
+
+
+def test_metal_prefilter_passes_every_token_the_atom_parser_flags():
+    for token in (b" FE ", b" 1ZN ", b" 'Zn' ", b" FE1 ", b" k+ "):
+        assert gen._METAL_AC.search(token) is not None
+    assert gen._METAL_AC.search(b" C1 c3 HC CAA ") is None
+
+
+def _baseline_split(lines):
+    # steps 8 and 9 as the script originally did them, on decoded lines
+    ff = []
+    in_block = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("[ defaults ]") or stripped.startswith("[ atomtypes ]"):
+            in_block = True
+        elif in_block and stripped.startswith("[") and not stripped.startswith("[ atomtypes ]"):
+            break
+        if in_block:
+            ff.append(line)
+    keep = {"[ moleculetype ]", "[ atoms ]", "[ bonds ]",
+            "[ pairs ]", "[ angles ]", "[ dihedrals ]"}
+    kept, write = [], False
+    for line in lines:
+        stripped = line.strip()
+        if any(stripped.startswith(h) for h in keep):
+            write = True
+        elif write and stripped.startswith("[") and stripped not in keep:
+            write = False
+        if write:
+            kept.append(line)
+    return "".join(ff).encode(), "".join(kept).encode()
+
+
+def test_split_itp_matches_parmed_example(tmp_path):
+    parm = gen.AmberParm(os.path.join(HEM, "3ARC_HEM.prmtop"),
+                         os.path.join(HEM, "3ARC_HEM.rst7"))
+    parm.save(str(tmp_path / "3ARC_HEM.itp"), format="gromacs")
+    raw = (tmp_path / "3ARC_HEM.itp").read_bytes()
+
+    ff, keep = gen.split_itp(raw)
+    assert (ff, keep) == _baseline_split(raw.decode().splitlines(keepends=True))
+    with open(os.path.join(HEM, "3ARC_HEM_forcefield.itp"), "rb") as f:
+        assert ff == f.read()
+    with open(os.path.join(HEM, "3ARC_HEM.itp"), "rb") as f:
+        assert keep == f.read()
+
+
+def test_split_itp_section_edge_cases():
+    raw = (b"; header\n"
+           b"[defaults]\n1 2 yes 0.5 0.8333\n\n"
+           b"[  atomtypes ]\nFE FE 0.0 0.0 A 0.1 0.2\n\n"
+           b"[ moleculetype ]\nHEM 3\n\n"
+           b"[dihedrals]\n1 2 3 4 9\n\n"
+           b"[ defaults ]\nagain\n"
+           b"[ system ]\nsys\n")
+    ff, keep = gen.split_itp(raw)
+    assert ff == (b"[defaults]\n1 2 yes 0.5 0.8333\n\n"
+                  b"[  atomtypes ]\nFE FE 0.0 0.0 A 0.1 0.2\n\n")
+    assert keep == (b"[ moleculetype ]\nHEM 3\n\n"
+                    b"[dihedrals]\n1 2 3 4 9\n\n")
+
+
+def test_mol2_has_metal_ignores_sidecar_from_other_version(tmp_path):
+    mol2 = _mol2(tmp_path, [("C1", "c3")])
+    st = os.stat(mol2)
+    sidecar = tmp_path / "lig.mol2.metalcache"
+    sidecar.write_text('{"v": 0, "size": %d, "mtime_ns": %d, "has_metal": true}'
+                       % (st.st_size, st.st_mtime_ns))
+    assert gen.mol2_has_metal(mol2) is False
+    assert '"v": %d' % gen._METALCACHE_VERSION in sidecar.read_text()
+    assert not (tmp_path / "lig.mol2.metalcache.tmp").exists()
+
+
+def test_mol2_has_metal_does_not_cache_read_errors(tmp_path, monkeypatch):
+    mol2 = _mol2(tmp_path, [("C1", "c3")])
+    real_scan = gen._scan_mol2_metal
+
+    def flaky_scan(path):
+        monkeypatch.setattr(gen, "_scan_mol2_metal", real_scan)
+        raise OSError("transient")
+
+    monkeypatch.setattr(gen, "_scan_mol2_metal", flaky_scan)
+    assert gen.mol2_has_metal(mol2) is True
+    assert gen.mol2_has_metal(mol2) is False
+
+
+def test_write_atomic_removes_temp_file_on_error(tmp_path, monkeypatch):
+    target = tmp_path / "lig.itp"
+    target.write_bytes(b"old")
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(gen.os, "replace", failing_replace)
+    with pytest.raises(OSError, match="disk full"):
+        gen.write_atomic(str(target), b"new")
+    assert target.read_bytes() == b"old"
+    assert not (tmp_path / "lig.itp.tmp").exists()
+
+
+def test_require_files_reports_every_missing_file(tmp_path, capsys):
+    (tmp_path / "lig.mol2").write_text("")
+    with pytest.raises(SystemExit) as exc:
+        gen.require_files([str(tmp_path / "lig.mol2"), str(tmp_path / "lig.frcmod"),
+                           str(tmp_path / "nodir" / "leaprc.gaff")])
+    assert exc.value.code == 1
+    err = capsys.readouterr().err
+    assert "lig.frcmod" in err and "leaprc.gaff" in err and "lig.mol2" not in err
+
+
+def test_require_files_falls_back_to_isfile(tmp_path, monkeypatch):
+    (tmp_path / "lig.mol2").write_text("")
+    (tmp_path / "empty").mkdir()
+    # listing lacks the name (different case/normalisation, or unlistable directory)
+    real_scandir = os.scandir
+    monkeypatch.setattr(gen.os, "scandir", lambda d: real_scandir(tmp_path / "empty"))
+    gen.require_files([str(tmp_path / "lig.mol2")])
+
+
+def test_write_file_replaces_contents_and_honours_umask(tmp_path):
+    target = tmp_path / "topol.top"
+    target.write_text("a much longer old payload\n")
+    old = os.umask(0o002)
+    try:
+        gen.write_file(str(target), "héllo\n")
+        gen.write_file(str(tmp_path / "leap.in"), "quit\n")
+    finally:
+        os.umask(old)
+    assert target.read_text() == "héllo\n"
+    assert (tmp_path / "leap.in").stat().st_mode & 0o777 == 0o664
+
+
+def _fake_tleap(tmp_path, monkeypatch, log):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    (tmp_path / "tleap.out").write_bytes(log)
+    tleap = bindir / "tleap"
+    tleap.write_text("#!/bin/sh\ncat '%s'\nexit 1\n" % (tmp_path / "tleap.out"))
+    tleap.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.chdir(tmp_path)
+
+
+def test_run_tleap_ignores_unknown_atom_type_notes(tmp_path, monkeypatch):
+    # a clean build loading a frcmod with new types prints "(UNKNOWN ATOM TYPE: FE)"
+    with open(os.path.join(HEM, "leap.log"), "rb") as f:
+        log = f.read()
+    assert b"UNKNOWN ATOM TYPE" in log
+    _fake_tleap(tmp_path, monkeypatch, log)
+    assert gen.run_tleap("P", "a.mol2", "a.frcmod", ["leaprc.gaff"]) == (False, False)
+    assert (tmp_path / "leap.in").read_text().startswith("source leaprc.gaff\n")
+
+
+def test_run_tleap_flags_typing_failures(tmp_path, monkeypatch):
+    for i, line in enumerate((
+        b"Could not find bond parameter for: FE - NP\n",
+        b"Could not find angle parameter: CC - NP - FE\n",
+        b"FATAL:  Atom .R<HEM 1>.A<FE 1> does not have a type.\n",
+        b"Failed to generate parameters\n",
+    )):
+        case = tmp_path / str(i)
+        case.mkdir()
+        with monkeypatch.context() as m:
+            _fake_tleap(case, m, b"(UNKNOWN ATOM TYPE: FE)\n" + line)
+            assert gen.run_tleap("P", "a.mol2", "a.frcmod", ["leaprc.gaff"]) == (False, True)
+
+
+def test_generate_one_reports_failures(monkeypatch, capsys):
+    def exit_with_message(params):
+        sys.exit("ERROR: tleap not found on PATH")
+
+    def crash(params):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(gen, "generate", exit_with_message)
+    assert gen._generate_one({"prefix": "P"}) == 1
+    assert "[P] ERROR: tleap not found on PATH" in capsys.readouterr().err
+
+    monkeypatch.setattr(gen, "generate", crash)
+    assert gen._generate_one({"prefix": "P"}) == 1
+    assert "RuntimeError: boom" in capsys.readouterr().err
+
+
+class _InlinePool:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, rows, chunksize=1):
+        return [fn(row) for row in rows]
+
+
+LEAP_FLAGS = ["--leap-prot", "p", "--leap-lipid", "l", "--leap-gaff", "g"]
+
+
+def test_manifest_blank_cells_fall_back_to_flags(tmp_path, monkeypatch):
+    manifest = tmp_path / "ligands.csv"
+    manifest.write_text("mol2,frcmod,prefix,leap_gaff\n"
+                        "a/a.mol2,a/a.frcmod, A ,  \n"
+                        "b/b.mol2,b/b.frcmod,B,custom.gaff\n")
+    monkeypatch.chdir(tmp_path)
+    built = []
+    monkeypatch.setattr(gen, "generate", built.append)
+    monkeypatch.setattr(gen.multiprocessing, "Pool", _InlinePool)
+    gen.main(["--manifest", str(manifest)] + LEAP_FLAGS)
+    assert [row["prefix"] for row in built] == ["A", "B"]
+    assert built[0]["leap_gaff"] == str(tmp_path / "g")
+    assert built[1]["leap_gaff"] == str(tmp_path / "custom.gaff")
+
+
+def test_manifest_rejects_ligands_sharing_a_directory(tmp_path, monkeypatch):
+    manifest = tmp_path / "ligands.csv"
+    manifest.write_text("mol2,frcmod,prefix\n"
+                        "lig/a.mol2,lig/a.frcmod,A\n"
+                        "lig/b.mol2,lig/b.frcmod,B\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gen, "generate", lambda params: None)
+    with pytest.raises(SystemExit, match="own directory"):
+        gen.main(["--manifest", str(manifest)] + LEAP_FLAGS)
+
+
+def test_jobs_must_be_positive(capsys):
+    for jobs in ("0", "-2"):
+        with pytest.raises(SystemExit):
+            gen.parse_args(["--manifest", "ligands.csv", "-j", jobs])
+        assert "must be at least 1" in capsys.readouterr().err
+
+
+def test_metal_tokens_cover_every_case_spelling():
+    symbols = {m.capitalize() for m in gen._METAL_TOKENS}
+    assert symbols == set(gen._METALS)
+    for token in (b"FE", b"Fe", b"fE", b"fe", b"K", b"k"):
+        assert token in gen._METAL_TOKENS
+    assert b"C" not in gen._METAL_TOKENS and b"" not in gen._METAL_TOKENS